@@ -1,31 +1,103 @@
 import os
+import functools
+import gzip
+import hashlib
+import numpy as np
 import yfinance as yf
+import httpx
 import requests
+import requests_cache
 import time
 import logging
-import json
+import math
+import orjson
+import queue
+import random
+import secrets
+import sqlite3
 import threading
-from flask import Flask, redirect, url_for, render_template_string, request, session, jsonify
+from collections import OrderedDict, defaultdict
+from urllib.parse import quote, urlencode
+from datetime import datetime, timedelta, time as dtime
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, Response, redirect, url_for, render_template, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from jinja2 import FileSystemBytecodeCache
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 
 # --- Setup Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("stock_alert_bot")
+# httpx logs every request URL at INFO, and our URLs carry secrets (the webhook token).
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # --- Environment Variables (Secrets) ---
 DISCORD_CLIENT_ID = os.environ.get("DISCORD_CLIENT_ID")
 DISCORD_CLIENT_SECRET = os.environ.get("DISCORD_CLIENT_SECRET")
 DISCORD_REDIRECT_URI = os.environ.get("DISCORD_REDIRECT_URI")
 DISCORD_WEBHOOK_URL = os.environ.get("DISCORD_WEBHOOK_URL")
+FINNHUB_API_KEY = os.environ.get("FINNHUB_API_KEY")  # Optional: faster quotes for US symbols
 
 if not all([DISCORD_CLIENT_ID, DISCORD_CLIENT_SECRET, DISCORD_REDIRECT_URI, DISCORD_WEBHOOK_URL]):
     logger.error("❌ กรุณาตั้งค่า DISCORD_CLIENT_ID, DISCORD_CLIENT_SECRET, DISCORD_REDIRECT_URI และ DISCORD_WEBHOOK_URL ใน Environment Variables ให้ครบถ้วน")
+    # Without these neither login nor notifications can work, so refuse to start at all.
+    raise SystemExit(1)
     
 # --- Flask App Setup ---
+def load_secret_key(file_path='.secret_key'):
+    """Uses SECRET_KEY from the environment, else a random key persisted on first start.
+
+    A stable key keeps sessions valid across restarts so users don't have to log in through Discord again.
+    """
+    key = os.environ.get("SECRET_KEY")
+    if key:
+        return key
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    key = secrets.token_bytes(32)
+    try:
+        fd = os.open(file_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # Another process starting at the same moment created it first; use its key once written.
+        for _ in range(100):
+            with open(file_path, 'rb') as f:
+                key = f.read()
+            if key:
+                return key
+            time.sleep(0.01)
+        raise
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serves jsonify() and the tojson filter with orjson instead of the pure-Python encoder."""
+
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24)
+app.json = OrjsonProvider(app)
+# Cache compiled template bytecode on disk so restarts skip parsing templates/ again.
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+# Static URLs carry a content hash (see hashed_static_url), so browsers may cache them for a year.
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 31536000
+app.config['SECRET_KEY'] = load_secret_key()
+app.config['REMEMBER_COOKIE_DURATION'] = timedelta(days=30)
 
 login_manager = LoginManager()
+login_manager.session_protection = "basic"
 login_manager.init_app(app)
 
 # --- Database & User Management ---
@@ -39,68 +111,285 @@ class User(UserMixin):
         return self.id
 
 class Database:
-    def __init__(self, file_path='discord_users.json'):
+    def __init__(self, file_path='discord_users.db', legacy_json_path='discord_users.json'):
         self.file_path = file_path
-        self.data = self.load_data()
-
-    def load_data(self):
+        self.conn = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        # All writes go through this one connection; statements from one thread must never land
+        # inside another thread's open transaction. Reads use per-thread connections instead, which
+        # WAL lets run concurrently with each other and with the writer.
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._pending_snapshot = (None, None, [])  # (reader, data version, rows) from the last pending read
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode NORMAL only syncs at checkpoints and is still crash-safe; FULL syncs every commit.
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS users (
+                id TEXT PRIMARY KEY,
+                username TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS targets (
+                user_id TEXT NOT NULL,
+                symbol TEXT NOT NULL,
+                target REAL NOT NULL,
+                trigger_type TEXT NOT NULL,
+                notified INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, symbol)
+            );
+            CREATE INDEX IF NOT EXISTS targets_symbol ON targets(symbol);
+        """)
+        columns = {row['name'] for row in self.conn.execute("PRAGMA table_info(targets)")}
+        if 'notified' not in columns:
+            self.conn.execute("ALTER TABLE targets ADD COLUMN notified INTEGER NOT NULL DEFAULT 0")
+        # Covering partial index: the checker's pending scan only touches rows that can still fire
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS targets_pending
+            ON targets(user_id, symbol, target, trigger_type) WHERE notified = 0
+        """)
+        self.import_legacy_json(legacy_json_path)
+
+    def reader(self):
+        """Returns this thread's read-only connection, opening it on first use."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(f"file:{self.file_path}?mode=ro", uri=True,
+                                                      isolation_level=None)
+            conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Groups several statements into a single commit (one WAL sync instead of one per row)."""
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def import_legacy_json(self, json_path):
+        """One-time migration of the old discord_users.json file into an empty database."""
+        if self.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            return
         try:
-            with open(self.file_path, 'r') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
-
-    def save_data(self):
-        with open(self.file_path, 'w') as f:
-            json.dump(self.data, f, indent=4)
+            with open(json_path, 'rb') as f:
+                data = orjson.loads(f.read())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            return
+
+        with self.transaction() as conn:
+            for user_data in data.values():
+                conn.execute("INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)",
+                             (str(user_data['id']), user_data['username']))
+                conn.executemany(
+                    "INSERT OR REPLACE INTO targets (user_id, symbol, target, trigger_type) VALUES (?, ?, ?, ?)",
+                    [(str(user_data['id']), symbol, t['target'], t.get('trigger_type', 'below'))
+                     for symbol, t in user_data.get('targets', {}).items()])
+        logger.info(f"Imported {len(data)} users from {json_path}")
 
     def get_user(self, user_id):
-        user_data = self.data.get(str(user_id))
-        if user_data:
-            user = User(user_data['id'], user_data['username'])
-            user.targets = user_data['targets']
+        row = self.reader().execute("SELECT id, username FROM users WHERE id = ?", (str(user_id),)).fetchone()
+        if row:
+            user = User(row['id'], row['username'])
+            user.targets = self.get_targets(row['id'])
             return user
         return None
 
     def add_user(self, user):
-        self.data[str(user.id)] = {'id': user.id, 'username': user.username, 'targets': {}}
-        self.save_data()
-
-    def update_user_targets(self, user_id, targets):
-        if str(user_id) in self.data:
-            self.data[str(user_id)]['targets'] = targets
-            self.save_data()
+        with self._lock:
+            self.conn.execute("INSERT OR IGNORE INTO users (id, username) VALUES (?, ?)", (str(user.id), user.username))
+
+    def get_targets(self, user_id):
+        rows = self.reader().execute("SELECT symbol, target, trigger_type FROM targets WHERE user_id = ?",
+                                     (str(user_id),))
+        return {row['symbol']: {'target': row['target'], 'trigger_type': row['trigger_type']} for row in rows}
+
+    def has_pending_target(self, user_id, symbol, target, trigger_type):
+        """True if exactly this target is already stored and has not fired yet."""
+        return self.reader().execute(
+            "SELECT 1 FROM targets WHERE user_id = ? AND symbol = ? AND target = ? AND trigger_type = ? AND notified = 0",
+            (str(user_id), symbol, target, trigger_type)).fetchone() is not None
+
+    def set_target(self, user_id, symbol, target, trigger_type):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO targets (user_id, symbol, target, trigger_type) VALUES (?, ?, ?, ?)",
+                              (str(user_id), symbol, target, trigger_type))
+
+    def delete_target(self, user_id, symbol):
+        with self._lock:
+            cur = self.conn.execute("DELETE FROM targets WHERE user_id = ? AND symbol = ?", (str(user_id), symbol))
+            return cur.rowcount > 0
+
+    def get_pending_targets(self):
+        """Returns every target that hasn't fired yet, reusing the last snapshot if nothing was written since."""
+        conn = self.reader()
+        # data_version moves whenever any other connection (our writer included) commits.
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        cached_conn, cached_version, rows = self._pending_snapshot
+        if conn is not cached_conn or version != cached_version:
+            rows = conn.execute(
+                "SELECT user_id, symbol, target, trigger_type FROM targets WHERE notified = 0").fetchall()
+            self._pending_snapshot = (conn, version, rows)
+        return rows
+
+    def mark_notified(self, fired, notified=True):
+        """Flags (user_id, symbol) pairs as notified, or back to pending with notified=False."""
+        with self.transaction() as conn:
+            conn.executemany("UPDATE targets SET notified = ? WHERE user_id = ? AND symbol = ?",
+                             [(int(notified), str(user_id), symbol) for user_id, symbol in fired])
+
+    def get_notified_symbols(self):
+        """Returns the symbols that have at least one target which already fired."""
+        return {row['symbol'] for row in self.reader().execute(
+            "SELECT DISTINCT symbol FROM targets WHERE notified = 1")}
+
+    def rearm_targets(self, prices):
+        """Puts fired targets back to pending once the price is on the far side of the target again."""
+        with self.transaction() as conn:
+            conn.executemany("""
+                UPDATE targets SET notified = 0
+                WHERE notified = 1 AND symbol = ?
+                  AND ((trigger_type = 'above' AND ? < target) OR (trigger_type = 'below' AND ? > target))
+            """, [(symbol, price, price) for symbol, price in prices.items()])
 
 db = Database()
 
+USER_CACHE_TTL = 300  # seconds
+USER_CACHE_MAX = 1024  # users kept in memory; least recently used are dropped first
+
+_user_cache = OrderedDict()  # user_id -> (User, monotonic timestamp), in LRU order
+_user_cache_lock = threading.Lock()
+# Bumped on every eviction; a load that started before one must not store its (possibly stale) user.
+_user_cache_generation = 0
+
 @login_manager.user_loader
 def load_user(user_id):
-    return db.get_user(user_id)
+    # Flask-Login resolves the user on every request; serve repeat lookups from memory.
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+        if cached and time.monotonic() - cached[1] < USER_CACHE_TTL:
+            _user_cache.move_to_end(user_id)
+            return cached[0]
+        _user_cache.pop(user_id, None)
+        generation = _user_cache_generation
+    user = db.get_user(user_id)
+    if user:
+        with _user_cache_lock:
+            if generation == _user_cache_generation:
+                _user_cache[user_id] = (user, time.monotonic())
+                while len(_user_cache) > USER_CACHE_MAX:
+                    _user_cache.popitem(last=False)
+    return user
+
+def evict_cached_user(user_id):
+    global _user_cache_generation
+    with _user_cache_lock:
+        _user_cache.pop(str(user_id), None)
+        _user_cache_generation += 1
 
 # --- Discord OAuth2 Logic ---
 DISCORD_API_BASE = 'https://discord.com/api/v10'
+DISCORD_TOKEN_URL = f"{DISCORD_API_BASE}/oauth2/token"
+DISCORD_ME_URL = f"{DISCORD_API_BASE}/users/@me"
+DISCORD_AUTHORIZE_URL = "https://discord.com/oauth2/authorize?" + urlencode({
+    'client_id': DISCORD_CLIENT_ID,
+    'redirect_uri': DISCORD_REDIRECT_URI,
+    'response_type': 'code',
+    'scope': 'identify',
+})
+
+class TokenBucket:
+    """Thread-safe token bucket used to pace outgoing calls to a single host."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# One pooled HTTP/2 client shared by every Discord call; webhooks get their own bucket
+# because Discord limits them separately (5 requests per 2 seconds). The transport retries
+# failed connects so a dropped keep-alive connection doesn't lose a notification.
+discord_session = httpx.Client(
+    timeout=10,
+    transport=httpx.HTTPTransport(
+        http2=True, retries=2,
+        limits=httpx.Limits(max_connections=16, max_keepalive_connections=4),
+    ),
+)
+discord_rate_limiter = TokenBucket(rate=1, burst=10)
+webhook_rate_limiter = TokenBucket(rate=2.5, burst=5)
+
+def discord_api_request(method, url, max_attempts=3, rate_limiter=discord_rate_limiter, **kwargs):
+    """Calls the Discord API, backing off on 429 according to Retry-After and on gateway errors."""
+    for attempt in range(max_attempts):
+        rate_limiter.acquire()
+        r = discord_session.request(method, url, **kwargs)
+        if r.status_code == 429:
+            try:
+                retry_after = float(r.headers.get('Retry-After', 2 ** attempt))
+            except ValueError:
+                retry_after = 2 ** attempt
+            logger.warning(f"Discord API rate limited on {method} request, retrying in {retry_after}s")
+        elif r.status_code in (502, 503) or (r.status_code == 504 and method != 'POST'):
+            # A 504 may arrive after the POST was already processed; resending it could post a
+            # duplicate alert. (Connect errors are retried by the transport.)
+            retry_after = 0.5 * 2 ** attempt
+            logger.warning(f"Discord API returned {r.status_code} on {method} request, retrying in {retry_after}s")
+        else:
+            return r
+        if attempt + 1 < max_attempts:
+            time.sleep(retry_after)
+    return r
+
+def exchange_code(code):
+    data = {
+        'client_id': DISCORD_CLIENT_ID,
+        'client_secret': DISCORD_CLIENT_SECRET,
+        'grant_type': 'authorization_code',
+        'code': code,
+        'redirect_uri': DISCORD_REDIRECT_URI,
+        'scope': 'identify'
+    }
+    # The code is single-use: if Discord consumed it before a gateway error, a resend can only
+    # fail with invalid_grant, so make exactly one attempt.
+    return discord_api_request('POST', DISCORD_TOKEN_URL, max_attempts=1, data=data)
+
+def fetch_me(access_token):
+    return discord_api_request('GET', DISCORD_ME_URL,
+                               headers={'Authorization': f'Bearer {access_token}'})
 
 @app.route('/login')
 def login_discord():
-    return redirect(f"https://discord.com/oauth2/authorize?client_id={DISCORD_CLIENT_ID}&redirect_uri={DISCORD_REDIRECT_URI}&response_type=code&scope=identify")
+    # An existing session already identifies the user; skip the OAuth round-trips entirely.
+    if current_user.is_authenticated:
+        return redirect(url_for('dashboard'))
+    return redirect(DISCORD_AUTHORIZE_URL)
 
 @app.route('/callback')
 def callback():
+    if current_user.is_authenticated:
+        return redirect(url_for('dashboard'))
     code = request.args.get('code')
     if not code:
         return "Authorization failed.", 400
 
-    token_url = f"{DISCORD_API_BASE}/oauth2/token"
-    data = {
-        'client_id': DISCORD_CLIENT_ID,
-        'client_secret': DISCORD_CLIENT_SECRET,
-        'grant_type': 'authorization_code',
-        'code': code,
-        'redirect_uri': DISCORD_REDIRECT_URI,
-        'scope': 'identify'
-    }
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-    r = requests.post(token_url, data=data, headers=headers)
+    r = exchange_code(code)
     
     if r.status_code != 200:
         logger.error(f"Failed to get token: {r.text}")
@@ -109,9 +398,7 @@ def callback():
     token_info = r.json()
     access_token = token_info.get('access_token')
 
-    user_url = f"{DISCORD_API_BASE}/users/@me"
-    user_headers = {'Authorization': f'Bearer {access_token}'}
-    user_r = requests.get(user_url, headers=user_headers)
+    user_r = fetch_me(access_token)
 
     if user_r.status_code != 200:
         logger.error(f"Failed to get user info: {user_r.text}")
@@ -126,277 +413,571 @@ def callback():
         user = User(user_id, username)
         db.add_user(user)
 
-    login_user(user)
+    login_user(user, remember=True)
     return redirect(url_for('dashboard'))
 
+# --- Templates & Static Files ---
+@functools.cache
+def static_file_hash(filename):
+    with open(os.path.join(app.static_folder, filename), 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+@app.url_defaults
+def hashed_static_url(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values.setdefault('v', static_file_hash(values['filename']))
+
+@app.after_request
+def mark_static_immutable(response):
+    if request.endpoint == 'static':
+        response.cache_control.immutable = True
+    return response
+
+@functools.cache
+def rendered_index():
+    """Renders and gzips the login page once; it is identical for every anonymous visitor."""
+    html = render_template('index.html').encode('utf-8')
+    return html, gzip.compress(html), hashlib.sha256(html).hexdigest()[:32]
+
 # --- Web Application Routes ---
 @app.route('/')
 def index():
     if current_user.is_authenticated:
         return redirect(url_for('dashboard'))
-    return render_template_string("""
-        <!doctype html>
-        <html lang="th">
-        <head>
-            <meta charset="utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">
-            <title>ล็อกอินด้วย Discord</title>
-            <style>
-                body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; text-align: center; padding-top: 50px; background-color: #f0f2f5; color: #333; }
-                .container { max-width: 450px; margin: auto; padding: 40px; border-radius: 12px; background-color: white; box-shadow: 0 10px 20px rgba(0,0,0,0.05); }
-                h1 { color: #5865F2; margin-bottom: 20px; }
-                .btn { padding: 12px 20px; border: none; border-radius: 8px; cursor: pointer; font-size: 16px; transition: background-color 0.3s; }
-                .btn-discord { background-color: #5865F2; color: white; text-decoration: none; }
-                .btn-discord:hover { background-color: #4B55C4; }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>เข้าสู่ระบบด้วย Discord</h1>
-                <a href="/login" class="btn btn-discord">เข้าสู่ระบบด้วย Discord</a>
-            </div>
-        </body>
-        </html>
-    """)
+    html, html_gzip, etag = rendered_index()
+    if request.accept_encodings['gzip']:
+        response = Response(html_gzip, mimetype='text/html')
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(f"{etag}-gzip")
+    else:
+        response = Response(html, mimetype='text/html')
+        response.set_etag(etag)
+    response.vary.update(('Accept-Encoding', 'Cookie'))
+    # Revalidate every time so logged-in visitors still get redirected; repeats cost only a 304.
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 @app.route('/logout')
 @login_required
 def logout():
+    evict_cached_user(current_user.id)
     logout_user()
     return redirect(url_for('index'))
 
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    targets = db.get_user(current_user.id).targets
-    return render_template_string("""
-        <!doctype html>
-        <html lang="th">
-        <head>
-            <meta charset="utf-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1, shrink-to-fit=no">
-            <title>Dashboard</title>
-            <style>
-                body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; padding: 20px; background-color: #f0f2f5; color: #333; }
-                .container { max-width: 800px; margin: auto; padding: 40px; border-radius: 12px; background-color: white; box-shadow: 0 10px 20px rgba(0,0,0,0.05); }
-                .header { display: flex; justify-content: space-between; align-items: center; margin-bottom: 30px; }
-                h2 { color: #5865F2; }
-                .target-form { margin-top: 20px; padding: 30px; border: 1px solid #ddd; border-radius: 12px; background-color: #fafafa; }
-                .form-group { margin-bottom: 15px; }
-                .form-group input, .form-group select { width: 100%; padding: 12px; border: 1px solid #ccc; border-radius: 8px; box-sizing: border-box; }
-                .btn { padding: 12px 20px; border: none; border-radius: 8px; cursor: pointer; font-size: 16px; transition: background-color 0.3s; }
-                .btn-success { background-color: #28a745; color: white; }
-                .btn-danger { background-color: #dc3545; color: white; }
-                .logout-btn { background-color: #5865F2; color: white; padding: 10px 20px; text-decoration: none; border-radius: 8px; }
-                .target-list { margin-top: 30px; }
-                .target-item { display: flex; justify-content: space-between; align-items: center; padding: 15px; margin-bottom: 10px; border: 1px solid #eee; border-radius: 8px; background-color: #fcfcfc; }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <div class="header">
-                    <h2>สวัสดี, {{ current_user.username }}</h2>
-                    <a href="{{ url_for('logout') }}" class="logout-btn">ออกจากระบบ</a>
-                </div>
-                
-                <div class="target-form">
-                    <h3>ตั้งเป้าหมายหุ้นใหม่</h3>
-                    <form id="set-target-form">
-                        <div class="form-group">
-                            <label for="symbol">ชื่อหุ้น:</label>
-                            <input type="text" id="symbol" name="symbol" placeholder="เช่น AAPL หรือ PTT.BK" required>
-                        </div>
-                        <div class="form-group">
-                            <label for="target_price">ราคาเป้าหมาย:</label>
-                            <input type="number" step="0.01" id="target_price" name="target_price" placeholder="ราคาเป้าหมายเป็นตัวเลข" required>
-                        </div>
-                        <div class="form-group">
-                            <label for="trigger_type">เงื่อนไขการแจ้งเตือน:</label>
-                            <select id="trigger_type" name="trigger_type">
-                                <option value="below">ราคาต่ำกว่า/เท่ากับ</option>
-                                <option value="above">ราคาสูงกว่า/เท่ากับ</option>
-                            </select>
-                        </div>
-                        <button type="submit" class="btn btn-success">ตั้งค่า</button>
-                    </form>
-                </div>
-
-                <div class="target-list" id="target-list">
-                    <h3>รายการเป้าหมายหุ้นของคุณ</h3>
-                    <div id="target-items">
-                        </div>
-                    <p id="no-targets-message" style="display: none;">คุณยังไม่ได้ตั้งเป้าหมายหุ้นใดๆ</p>
-                </div>
-            </div>
-            
-            <script>
-                const targets = {{ targets | tojson }};
-                const targetListElement = document.getElementById('target-items');
-                const noTargetsMessage = document.getElementById('no-targets-message');
-
-                function renderTargets() {
-                    targetListElement.innerHTML = '';
-                    if (Object.keys(targets).length === 0) {
-                        noTargetsMessage.style.display = 'block';
-                    } else {
-                        noTargetsMessage.style.display = 'none';
-                        for (const symbol in targets) {
-                            const data = targets[symbol];
-                            const triggerText = data.trigger_type === 'below' ? 'ราคาต่ำกว่า/เท่ากับ' : 'ราคาสูงกว่า/เท่ากับ';
-                            const targetItemHTML = `
-                                <div class="target-item">
-                                    <div>
-                                        <strong>${symbol}</strong>: เป้าหมายที่ **${data.target}** บาท<br>
-                                        เงื่อนไข: ${triggerText}
-                                    </div>
-                                    <button class="btn btn-danger" onclick="deleteTarget('${symbol}')">ลบ</button>
-                                </div>
-                            `;
-                            targetListElement.innerHTML += targetItemHTML;
-                        }
-                    }
-                }
-
-                document.getElementById('set-target-form').onsubmit = async (e) => {
-                    e.preventDefault();
-                    const formData = new FormData(e.target);
-                    const data = Object.fromEntries(formData.entries());
-                    const response = await fetch('/api/set_target', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify(data)
-                    });
-                    const result = await response.json();
-                    alert(result.message);
-                    if (result.success) { 
-                        Object.assign(targets, result.targets);
-                        renderTargets();
-                    }
-                };
-
-                async function deleteTarget(symbol) {
-                    if (!confirm(`คุณต้องการลบเป้าหมายของหุ้น ${symbol} หรือไม่?`)) return;
-                    const response = await fetch('/api/delete_target', {
-                        method: 'POST',
-                        headers: { 'Content-Type': 'application/json' },
-                        body: JSON.stringify({ symbol: symbol })
-                    });
-                    const result = await response.json();
-                    alert(result.message);
-                    if (result.success) {
-                        delete targets[symbol];
-                        renderTargets();
-                    }
-                }
-                
-                document.addEventListener('DOMContentLoaded', renderTargets);
-            </script>
-        </body>
-        </html>
-    """, targets=targets)
+    # load_user already fetched the targets (and set/delete evict it), so don't query again.
+    return render_template('dashboard.html', targets=current_user.targets)
 
 # --- API Endpoints ---
 @app.route('/api/set_target', methods=['POST'])
 @login_required
 def api_set_target():
-    data = request.json
-    symbol = data.get('symbol', '').upper()
-    target_price = data.get('target_price')
-    trigger_type = data.get('trigger_type', 'below')
-    
+    data = request.get_json(silent=True) or {}
+    # Validate before touching the database so bad requests cost nothing.
     try:
-        target_price = float(target_price)
+        target_price = float(data.get('target_price'))
+        # SQLite stores NaN as NULL (breaking NOT NULL), and inf could never be crossed.
+        if not math.isfinite(target_price):
+            raise ValueError(target_price)
     except (ValueError, TypeError):
         return jsonify(success=False, message="❌ กรุณากรอกราคาเป็นตัวเลขที่ถูกต้อง"), 400
+    symbol = str(data.get('symbol', '')).strip().upper()
+    trigger_type = data.get('trigger_type', 'below')
+    if not symbol or trigger_type not in ('above', 'below'):
+        return jsonify(success=False, message="❌ ข้อมูลไม่ถูกต้อง"), 400
 
-    user = db.get_user(current_user.id)
-    user.targets[symbol] = {
-        'target': target_price,
-        'trigger_type': trigger_type
-    }
-    db.update_user_targets(current_user.id, user.targets)
-    
-    return jsonify(success=True, message=f"✅ ตั้งเป้าหมายสำหรับ **{symbol}** ที่ **{target_price}** บาทเรียบร้อยแล้ว", targets=user.targets)
+    user_id = current_user.id
+    targets = current_user.targets
+    # Resubmitting an unchanged, still-pending target (e.g. a double click) needs no write; one that
+    # already fired is written again so the resubmission re-arms it.
+    if not db.has_pending_target(user_id, symbol, target_price, trigger_type):
+        db.set_target(user_id, symbol, target_price, trigger_type)
+        evict_cached_user(user_id)
+        targets = db.get_targets(user_id)
+
+    return jsonify(success=True, message=f"✅ ตั้งเป้าหมายสำหรับ **{symbol}** ที่ **{target_price}** บาทเรียบร้อยแล้ว", targets=targets)
 
 @app.route('/api/delete_target', methods=['POST'])
 @login_required
 def api_delete_target():
-    data = request.json
-    symbol = data.get('symbol', '').upper()
-    user = db.get_user(current_user.id)
+    data = request.get_json(silent=True) or {}
+    symbol = str(data.get('symbol', '')).strip().upper()
+    user_id = current_user.id
     
-    if symbol in user.targets:
-        del user.targets[symbol]
-        db.update_user_targets(current_user.id, user.targets)
-        return jsonify(success=True, message=f"🗑️ ลบเป้าหมายสำหรับ **{symbol}** เรียบร้อยแล้ว", targets=user.targets)
+    if symbol and db.delete_target(user_id, symbol):
+        evict_cached_user(user_id)
+        return jsonify(success=True, message=f"🗑️ ลบเป้าหมายสำหรับ **{symbol}** เรียบร้อยแล้ว", targets=db.get_targets(user_id))
     else:
         return jsonify(success=False, message="❌ ไม่พบเป้าหมายที่คุณตั้งไว้"), 404
 
+@app.route('/api/price/<symbol>')
+@login_required
+def api_price(symbol):
+    symbol = symbol.strip().upper()
+    price = get_price(symbol)
+    if price is None:
+        return jsonify(success=False, message="❌ ไม่พบราคาหุ้นนี้"), 404
+    return jsonify(success=True, symbol=symbol, price=price)
+
 # --- Stock Check and Discord Notify Logic ---
-def fetch_price_blocking(symbol: str):
+CHECK_INTERVAL = 60  # seconds
+OFF_HOURS_CHECK_INTERVAL = 15 * 60  # seconds
+PRICE_CACHE_TTL = 60  # seconds; how stale a price /api/price may serve
+# The checker must see a fresh price every cycle, so its cache window stays well under CHECK_INTERVAL.
+CHECKER_PRICE_MAX_AGE = CHECK_INTERVAL / 2
+YAHOO_BATCH_SIZE = 20  # symbols per Yahoo request
+YAHOO_BACKOFF_BASE = 60  # seconds; first cooldown after Yahoo throttles us
+YAHOO_BACKOFF_MAX = 60 * 60  # seconds
+
+# Trading hours (local time, Mon-Fri) of the exchanges we can recognise from a symbol.
+MARKET_HOURS = {
+    'SET': (ZoneInfo('Asia/Bangkok'), dtime(10, 0), dtime(16, 30)),
+    'US': (ZoneInfo('America/New_York'), dtime(9, 30), dtime(16, 0)),
+}
+
+# Dedicated, bounded pool for blocking Yahoo lookups so an outage can't pile up unbounded threads.
+PRICE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="yf")
+
+# Finnhub's free tier allows 60 calls per minute.
+# The key goes in a header rather than the query string so it never appears in a logged URL.
+finnhub_session = httpx.Client(base_url="https://finnhub.io/api/v1", timeout=5,
+                               headers={"X-Finnhub-Token": FINNHUB_API_KEY or ""})
+finnhub_rate_limiter = TokenBucket(rate=1, burst=30)
+
+YAHOO_CHART_URL = "https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
+YAHOO_SPARK_URL = "https://query1.finance.yahoo.com/v8/finance/spark"
+
+YAHOO_HTTP_CACHE_TTL = 30  # seconds an identical Yahoo response is served without a request
+
+# Caches Yahoo responses in memory; once expired they are revalidated with ETag/Last-Modified, so
+# an unchanged quote comes back as a 304 without a body.
+yahoo_session = requests_cache.CachedSession(backend='memory', expire_after=YAHOO_HTTP_CACHE_TTL,
+                                             allowable_codes=(200,))
+# At most this many requests in flight to Yahoo at once, across batch and fallback fetches.
+yahoo_semaphore = threading.BoundedSemaphore(5)
+yahoo_session.headers['User-Agent'] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+
+_ticker_cache = {}
+_price_cache = {}  # symbol -> (price, monotonic timestamp); shared by the checker and web requests
+_price_cache_lock = threading.Lock()  # also guards _ticker_cache
+_yahoo_cooldown_until = 0.0  # monotonic time before which we don't call Yahoo at all
+_yahoo_backoff_level = 0
+_yahoo_backoff_lock = threading.Lock()
+
+def yahoo_cooling_down():
+    return time.monotonic() < _yahoo_cooldown_until
+
+def record_yahoo_status(status_code: int):
+    """Backs off exponentially (with jitter) while Yahoo answers 401/429, and resets once it recovers."""
+    global _yahoo_cooldown_until, _yahoo_backoff_level
+    with _yahoo_backoff_lock:
+        if status_code in (401, 429):
+            delay = min(YAHOO_BACKOFF_MAX, YAHOO_BACKOFF_BASE * 2 ** _yahoo_backoff_level)
+            delay += random.uniform(0, YAHOO_BACKOFF_BASE)
+            _yahoo_cooldown_until = max(_yahoo_cooldown_until, time.monotonic() + delay)
+            _yahoo_backoff_level += 1
+            logger.warning(f"Yahoo จำกัดการเรียกใช้ (HTTP {status_code}) หยุดดึงราคา {delay:.0f} วินาที")
+        elif status_code < 400:
+            _yahoo_backoff_level = 0
+
+def get_ticker(symbol: str):
+    """Returns a shared yf.Ticker so its session and metadata are reused across cycles."""
+    with _price_cache_lock:
+        ticker = _ticker_cache.get(symbol)
+        if ticker is None:
+            ticker = _ticker_cache[symbol] = yf.Ticker(symbol)
+    return ticker
+
+def get_cached_price(symbol: str, max_age=PRICE_CACHE_TTL):
+    with _price_cache_lock:
+        cached = _price_cache.get(symbol)
+    if cached and time.monotonic() - cached[1] < max_age:
+        return cached[0]
+    return None
+
+def cache_price(symbol: str, price: float):
+    with _price_cache_lock:
+        _price_cache[symbol] = (price, time.monotonic())
+
+def prune_price_cache(keep):
+    """Drops expired prices and Tickers for symbols no longer watched, e.g. one-off /api/price lookups."""
+    now = time.monotonic()
+    with _price_cache_lock:
+        stale = [symbol for symbol, (_, ts) in _price_cache.items()
+                 if symbol not in keep and now - ts >= PRICE_CACHE_TTL]
+        for symbol in stale:
+            del _price_cache[symbol]
+        # Same lock as get_ticker(): PRICE_EXECUTOR threads may be adding Tickers right now.
+        for symbol in [symbol for symbol in _ticker_cache if symbol not in keep]:
+            del _ticker_cache[symbol]
+    # Keep cached responses around long enough to revalidate them through an off-hours interval.
+    yahoo_session.cache.delete(older_than=timedelta(seconds=2 * OFF_HOURS_CHECK_INTERVAL))
+
+def parse_chart_price(chart):
+    """Extracts the latest price from a Yahoo chart/spark result, without building a DataFrame."""
+    price = chart['meta'].get('regularMarketPrice')
+    if price is None:
+        closes = [c for c in chart['indicators']['quote'][0].get('close') or [] if c is not None]
+        price = closes[-1] if closes else None
+    return float(price) if price is not None else None
+
+def fetch_chart_price(symbol: str):
+    """Reads the price from Yahoo's chart endpoint (conditional requests are handled by yahoo_session)."""
+    if yahoo_cooling_down():
+        return None
+    with yahoo_semaphore:
+        r = yahoo_session.get(YAHOO_CHART_URL.format(symbol=quote(symbol, safe='')),
+                              params={"range": "1d", "interval": "1m"}, timeout=10)
+    record_yahoo_status(r.status_code)
+    r.raise_for_status()
+    return parse_chart_price(orjson.loads(r.content)['chart']['result'][0])
+
+def fetch_price_blocking(symbol: str, max_age=PRICE_CACHE_TTL):
+    price = get_cached_price(symbol, max_age)
+    if price is not None:
+        return price
     try:
-        ticker = yf.Ticker(symbol)
-        data = ticker.history(period="1d", interval="1m")
-        if data.empty:
-            return None
-        return float(data["Close"].iloc[-1])
+        price = fetch_chart_price(symbol)
+    except (requests.exceptions.RequestException, KeyError, IndexError, TypeError, ValueError) as e:
+        logger.warning(f"ไม่สามารถดึงราคาหุ้น {symbol} จาก chart endpoint: {e}")
+        price = None
+    if price is not None:
+        cache_price(symbol, price)
+        return price
+    if yahoo_cooling_down():
+        return None
+    try:
+        # A throwaway Ticker, not get_ticker(): FastInfo memoises last_price for the Ticker's lifetime,
+        # so reading it from a cached Ticker would return the same price forever.
+        price = yf.Ticker(symbol).fast_info["last_price"]
+        if price is None or math.isnan(price):
+            # fast_info reports None/NaN for some listings; the minute bars may still have a close.
+            data = get_ticker(symbol).history(period="1d", interval="1m")
+            closes = data["Close"].dropna() if not data.empty else data
+            if closes.empty:
+                return None
+            price = closes.iloc[-1]
+        price = float(price)
+        cache_price(symbol, price)
+        return price
     except Exception as e:
         logger.warning(f"ไม่สามารถดึงราคาหุ้น {symbol}: {e}")
         return None
 
-def send_discord_webhook(message: str):
-    """Sends a message to a Discord channel via webhook."""
-    if not DISCORD_WEBHOOK_URL:
-        logger.warning("DISCORD_WEBHOOK_URL is not set. Cannot send notification.")
-        return
-
+def fetch_finnhub_quote(symbol: str, max_age=PRICE_CACHE_TTL):
+    """Fetches the current price from Finnhub's /quote endpoint (US symbols only)."""
+    price = get_cached_price(symbol, max_age)
+    if price is not None:
+        return price
+    finnhub_rate_limiter.acquire()
+    try:
+        r = finnhub_session.get("/quote", params={"symbol": symbol})
+        r.raise_for_status()
+        price = r.json().get("c")
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning(f"ไม่สามารถดึงราคาหุ้น {symbol} จาก Finnhub: {e}")
+        return None
+    # Finnhub answers unknown symbols with a zero price rather than an error.
+    if not price:
+        return None
+    price = float(price)
+    cache_price(symbol, price)
+    return price
+
+def download_prices(symbols):
+    """Fetches prices for one chunk of symbols with a single request to Yahoo's spark endpoint."""
+    if yahoo_cooling_down():
+        return {}
+    try:
+        with yahoo_semaphore:
+            r = yahoo_session.get(YAHOO_SPARK_URL, params={
+                "symbols": ",".join(symbols), "range": "1d", "interval": "1m", "indicators": "close",
+            }, timeout=10)
+        record_yahoo_status(r.status_code)
+        r.raise_for_status()
+        # Minute bars for a whole chunk add up to a sizeable body; orjson parses it several times faster.
+        results = orjson.loads(r.content)['spark']['result'] or []
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError, KeyError, TypeError) as e:
+        logger.warning(f"ไม่สามารถดึงราคาหุ้นแบบกลุ่ม: {e}")
+        return {}
+
+    prices = {}
+    for result in results:
+        try:
+            price = parse_chart_price(result['response'][0])
+        except (KeyError, IndexError, TypeError):
+            continue
+        if price is not None:
+            prices[result['symbol']] = price
+            cache_price(result['symbol'], price)
+    return prices
+
+def fetch_prices_batch(symbols, max_age=PRICE_CACHE_TTL):
+    """Fetches uncached symbols from Yahoo in concurrent chunks of YAHOO_BATCH_SIZE."""
+    prices = {}
+    for symbol in symbols:
+        price = get_cached_price(symbol, max_age)
+        if price is not None:
+            prices[symbol] = price
+    missing = sorted(set(symbols) - prices.keys())
+    chunks = [missing[i:i + YAHOO_BATCH_SIZE] for i in range(0, len(missing), YAHOO_BATCH_SIZE)]
+    for chunk_prices in PRICE_EXECUTOR.map(download_prices, chunks):
+        prices.update(chunk_prices)
+    return prices
+
+def fetch_prices(symbols, max_age=PRICE_CACHE_TTL):
+    """Fetches prices from Finnhub when configured, then Yahoo in batches, then per symbol for any misses.
+
+    Cached prices younger than max_age are reused instead of fetched.
+    """
+    prices = {}
+    if FINNHUB_API_KEY:
+        us_symbols = [symbol for symbol in symbols if symbol_market(symbol) == 'US']
+        quotes = PRICE_EXECUTOR.map(functools.partial(fetch_finnhub_quote, max_age=max_age), us_symbols)
+        for symbol, price in zip(us_symbols, quotes):
+            if price is not None:
+                prices[symbol] = price
+    prices.update(fetch_prices_batch(set(symbols) - prices.keys(), max_age))
+    missing = list(set(symbols) - prices.keys())
+    fallbacks = PRICE_EXECUTOR.map(functools.partial(fetch_price_blocking, max_age=max_age), missing)
+    for symbol, price in zip(missing, fallbacks):
+        if price is not None:
+            prices[symbol] = price
+    return prices
+
+def get_price(symbol: str):
+    """Returns the current price of one symbol, served from the shared cache when fresh."""
+    return fetch_prices({symbol}).get(symbol)
+
+def symbol_market(symbol: str):
+    """Returns the MARKET_HOURS key for a symbol, or None if its trading hours are unknown."""
+    if symbol.endswith('.BK'):
+        return 'SET'
+    if symbol.isalpha():
+        return 'US'
+    return None
+
+def is_market_open(market: str):
+    tz, opens_at, closes_at = MARKET_HOURS[market]
+    now = datetime.now(tz)
+    return now.weekday() < 5 and opens_at <= now.time() < closes_at
+
+def any_market_open(symbols):
+    # Symbols we can't place (crypto, FX, indices...) may trade around the clock.
+    markets = {symbol_market(symbol) for symbol in symbols}
+    return None in markets or any(is_market_open(market) for market in markets)
+
+def find_triggered_targets(rows, prices):
+    """Returns the indices of target rows whose condition holds, compared in one vectorised pass."""
+    count = len(rows)
+    if not count:
+        return []
+    # Group row indices by symbol with a dict (no sort), then resolve each symbol's price once.
+    rows_by_symbol = defaultdict(list)
+    for i, row in enumerate(rows):
+        rows_by_symbol[row['symbol']].append(i)
+    price_arr = np.full(count, np.nan)
+    for symbol, indices in rows_by_symbol.items():
+        price = prices.get(symbol)
+        if price is not None:
+            price_arr[indices] = price
+    targets_arr = np.fromiter((row['target'] for row in rows), dtype=float, count=count)
+    is_above_arr = np.fromiter((row['trigger_type'] == 'above' for row in rows), dtype=bool, count=count)
+    # Symbols without a price are NaN and never compare true.
+    hits = np.where(is_above_arr, price_arr >= targets_arr, price_arr <= targets_arr)
+    return np.flatnonzero(hits)
+
+EMBED_MAX_FIELDS = 25  # Discord's per-embed limit
+MESSAGE_MAX_EMBEDS = 10  # Discord's per-message limit
+MESSAGE_MAX_EMBED_CHARS = 6000  # Discord's limit on all embed text in one message
+ALERT_TITLE = "📢 แจ้งเตือนหุ้นถึงเป้าหมาย!"
+ALERT_FIELD_TEMPLATE = "ราคาปัจจุบัน: {price} บาท\nราคาเป้าหมาย: {target} บาท"
+
+def build_alert_embeds(user_id, alerts):
+    """Turns one user's (symbol, price, target) tuples into as few embeds as Discord allows.
+
+    Returns (embed, symbols) pairs so a failed delivery can re-arm exactly the targets it carried.
+    """
+    fields = [{
+        "name": symbol,
+        "value": ALERT_FIELD_TEMPLATE.format(price=price, target=target),
+        "inline": True,
+    } for symbol, price, target in alerts]
+    return [({
+        "title": ALERT_TITLE,
+        "description": f"<@{user_id}>",
+        "color": 0x5865F2,
+        "fields": fields[i:i + EMBED_MAX_FIELDS],
+    }, [symbol for symbol, _, _ in alerts[i:i + EMBED_MAX_FIELDS]])
+        for i in range(0, len(fields), EMBED_MAX_FIELDS)]
+
+def embed_text_length(embed):
+    """Counts the characters Discord sums toward MESSAGE_MAX_EMBED_CHARS."""
+    return (len(embed.get("title", "")) + len(embed.get("description", ""))
+            + sum(len(field["name"]) + len(field["value"]) for field in embed.get("fields", [])))
+
+# Only ever ping the users an alert is addressed to, never @everyone or roles.
+WEBHOOK_PAYLOAD_BASE = {"allowed_mentions": {"parse": ["users"]}}
+
+def send_discord_webhook(message: str = None, embeds=None):
+    """Sends a message to a Discord channel via webhook.
+
+    Returns True if Discord accepted it, False on a transient failure worth retrying (network
+    error, 429, 5xx), and None if Discord rejected it outright (deleted webhook, bad payload).
+    """
     payload = {
+        **WEBHOOK_PAYLOAD_BASE,
         "content": message
     }
+    if embeds:
+        payload["embeds"] = embeds
     try:
-        response = requests.post(DISCORD_WEBHOOK_URL, json=payload)
-        response.raise_for_status() # Raises an exception for bad status codes
+        response = discord_api_request('POST', DISCORD_WEBHOOK_URL, max_attempts=5,
+                                       rate_limiter=webhook_rate_limiter, json=payload)
+    except httpx.RequestError as e:
+        # Not str(e.request): the webhook URL carries its token.
+        logger.error(f"Error sending Discord webhook: {type(e).__name__}: {e}")
+        return False
+    if response.is_success:
         logger.info(f"Notification sent successfully to Discord via webhook.")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error sending Discord webhook: {e}")
+        return True
+    logger.error(f"Discord webhook returned {response.status_code}: {response.text[:200]}")
+    if response.status_code == 429 or response.status_code >= 500:
+        return False
+    return None
+
+# Bounded so a long webhook outage can't grow memory without limit; overflow is re-armed instead.
+notification_queue = queue.Queue(maxsize=1000)
+
+def deliver_alerts(triggered_by_user):
+    """Sends a whole cycle's alerts in as few messages as Discord allows.
+
+    Returns the (user_id, symbol) pairs whose message failed transiently and should be retried.
+    """
+    embeds = [(user_id, embed, symbols) for user_id, alerts in triggered_by_user.items()
+              for embed, symbols in build_alert_embeds(user_id, alerts)]
+    # Pack embeds greedily, starting a new message at either the embed count or the text limit.
+    batches, chars = [], 0
+    for item in embeds:
+        length = embed_text_length(item[1])
+        if not batches or len(batches[-1]) >= MESSAGE_MAX_EMBEDS or chars + length > MESSAGE_MAX_EMBED_CHARS:
+            batches.append([])
+            chars = 0
+        batches[-1].append(item)
+        chars += length
+
+    failed = []
+    for batch in batches:
+        mentions = " ".join(dict.fromkeys(f"<@{user_id}>" for user_id, _, _ in batch))
+        try:
+            sent = send_discord_webhook(mentions, embeds=[embed for _, embed, _ in batch])
+        except Exception:
+            # One failed message must not hold back the rest of the cycle's alerts.
+            logger.exception("Failed to send alert message")
+            sent = False
+        pairs = [(user_id, symbol) for user_id, _, symbols in batch for symbol in symbols]
+        if sent is False:
+            failed.extend(pairs)
+        elif sent is None:
+            # Resending the same payload would be rejected again every cycle; drop these alerts.
+            logger.error(f"Discord rejected an alert message; dropping {len(pairs)} alerts")
+    return failed
+
+def run_notifier():
+    while True:
+        triggered_by_user = notification_queue.get()
+        try:
+            failed = deliver_alerts(triggered_by_user)
+            if failed:
+                # Put the targets back to pending so the next cycle retries them.
+                db.mark_notified(failed, notified=False)
+        except Exception:
+            logger.exception("Failed to deliver or re-queue alerts")
+        finally:
+            notification_queue.task_done()
+
+_last_evaluated = (None, None)  # (pending rows, prices) of the last cycle that was evaluated
+
+def check_stock_targets():
+    """Runs one check cycle and returns how many seconds to wait before the next one."""
+    # Phase 1: take a plain snapshot of pending targets; no database work happens during network I/O.
+    rows = db.get_pending_targets()
+    fired_symbols = db.get_notified_symbols()
+    symbols = {row['symbol'] for row in rows} | fired_symbols
+    prune_price_cache(symbols)
+    if not symbols:
+        return CHECK_INTERVAL
+
+    # Phase 2: fetch every watched symbol once and evaluate.
+    logger.info("เริ่มตรวจสอบราคาหุ้น...")
+    prices = fetch_prices(symbols, max_age=CHECKER_PRICE_MAX_AGE)
+    # Prices barely move while every watched market is closed, so poll less often.
+    interval = CHECK_INTERVAL if any_market_open(symbols) else OFF_HOURS_CHECK_INTERVAL
+
+    # Same snapshot (nothing written since) and same prices can't trigger or re-arm anything new.
+    global _last_evaluated
+    if rows is _last_evaluated[0] and prices == _last_evaluated[1]:
+        logger.debug("Prices unchanged since the last check; skipping evaluation")
+        return interval
+    _last_evaluated = (rows, prices)
+
+    # Targets that fired only alert again after the condition has stopped holding, so a price
+    # sitting past its target doesn't ping every cycle.
+    if fired_symbols:
+        db.rearm_targets({symbol: prices[symbol] for symbol in fired_symbols if symbol in prices})
+
+    triggered_by_user = defaultdict(list)
+    for i in find_triggered_targets(rows, prices):
+        row = rows[i]
+        triggered_by_user[row['user_id']].append((row['symbol'], prices[row['symbol']], row['target']))
+
+    # Phase 3: record what fired in one short write, then hand delivery to the notifier thread
+    # so a slow webhook never stalls the check. Those targets stay quiet until re-armed above.
+    if triggered_by_user:
+        fired = [(user_id, symbol) for user_id, alerts in triggered_by_user.items() for symbol, _, _ in alerts]
+        db.mark_notified(fired)
+        try:
+            notification_queue.put_nowait(triggered_by_user)
+        except queue.Full:
+            logger.error("Notification queue is full; alerts will be retried next cycle")
+            db.mark_notified(fired, notified=False)
+
+    return interval
 
 def run_stock_checker():
     while True:
-        logger.info("เริ่มตรวจสอบราคาหุ้น...")
-        all_users_data = db.load_data()
-        
-        # In this simplified version, we're assuming the webhook is for a single user/purpose.
-        # You'll need to manually add the stocks to discord_users.json for testing.
-        for user_id_str, user_data in all_users_data.items():
-            targets_to_check = list(user_data.get('targets', {}).items())
-            
-            for symbol, data in targets_to_check:
-                target = data.get('target')
-                trigger_type = data.get('trigger_type', 'below')
-                
-                current_price = fetch_price_blocking(symbol)
-                if current_price is None:
-                    continue
-                
-                should_notify = False
-                if (trigger_type == 'below' and current_price <= target) or \
-                   (trigger_type == 'above' and current_price >= target):
-                    should_notify = True
-                
-                if should_notify:
-                    message = f"📢 แจ้งเตือนหุ้นถึงเป้าหมาย!\n" \
-                              f"หุ้น: {symbol}\n" \
-                              f"ราคาปัจจุบัน: {current_price} บาท\n" \
-                              f"ราคาเป้าหมาย: {target} บาท"
-                    
-                    send_discord_webhook(message)
-                    
-        time.sleep(60)
+        started = time.monotonic()
+        try:
+            interval = check_stock_targets()
+        except Exception:
+            # Keep the daemon thread alive; an uncaught error would silently stop all alerts.
+            logger.exception("Stock check cycle failed")
+            interval = CHECK_INTERVAL
+        # Sleep only for what's left of the interval so slow fetches don't push the cadence back.
+        elapsed = time.monotonic() - started
+        logger.debug(f"Stock check cycle took {elapsed:.1f}s")
+        time.sleep(max(0.0, interval - elapsed))
+
+# --- Background Tasks ---
+_background_started = False
+_background_lock = threading.Lock()
+
+def start_background_tasks():
+    """Starts the notifier and stock checker once per process, whichever server is hosting the app."""
+    global _background_started
+    with _background_lock:
+        if _background_started:
+            return
+        threading.Thread(target=run_notifier, daemon=True).start()
+        threading.Thread(target=run_stock_checker, daemon=True).start()
+        _background_started = True
 
 # --- Main Entry Point ---
 if __name__ == "__main__":
-    # Start the stock checker in a separate thread
-    threading.Thread(target=run_stock_checker, daemon=True).start()
+    # Local development only; production runs under gunicorn (see gunicorn.conf.py)
+    start_background_tasks()
     
     # Run the web server
     app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 8000)))
@@ -0,0 +1,13 @@
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+
+# The stock checker runs inside the worker, so keep a single worker per deployment
+# to avoid duplicate notifications; concurrency comes from threads instead.
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
+
+def post_worker_init(worker):
+    from app import start_background_tasks
+    start_background_tasks()